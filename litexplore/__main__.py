@@ -1,4 +1,5 @@
 import argparse
+import os
 import uvicorn
 
 
@@ -10,6 +11,9 @@ parser.add_argument("--port", type=int, required=False, default=8000)
 args = parser.parse_args()
 
 if args.dev:
+    # Read by the app settings (in the reloader processes too), e.g. to reload
+    # the templates when they change
+    os.environ.setdefault("LOG_LEVEL", "debug")
     uvicorn.run(
         "litexplore.app:app",
         host=args.host,
@@ -1,16 +1,22 @@
 from uuid import uuid4
 import asyncio
+import functools
+import hashlib
+import itertools
 import tempfile
 import urllib.parse
-import json
 import logging
 import logging.config
 import os
-import subprocess
-from collections import defaultdict
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union, cast
 
+import orjson
 from fastapi import (
     Cookie,
     Depends,
@@ -22,28 +28,24 @@ from fastapi import (
     Header,
 )
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 from pydantic import (
-    BaseModel as _BaseModel,
+    BaseModel,
     BaseSettings,
     Field,
-    validator,
-    PrivateAttr,
     UUID4,
 )
 
 
-class BaseModel(_BaseModel):
-    class Config:
-        frozen = True
-
-
 class Settings(BaseSettings):
     COOKIE_CONF: str = "ltx_conf"
     IN_TEST: str = "false"
     LOG_LEVEL: str = "info"
+    # JSON results compress very well, it's worth it on slow (WAN) links
+    SSH_COMPRESSION: bool = True
 
     # current module's path
     BASE_DIR: Path = Path(os.path.abspath(__file__)).parent
@@ -61,87 +63,79 @@ class Settings(BaseSettings):
 settings = Settings()
 
 
-_APP_LOGGER_INITIALIZED = False
-
-
-def get_logger() -> logging.Logger:
-
-    global _APP_LOGGER_INITIALIZED
-
-    if _APP_LOGGER_INITIALIZED:
-        log = logging.getLogger("app")
-        return log
+if settings.LOG_LEVEL == "debug":
+    LOG_LEVEL = logging.DEBUG
+else:
+    LOG_LEVEL = logging.INFO
 
-    if settings.LOG_LEVEL == "debug":
-        log_level = logging.DEBUG
-    else:
-        log_level = logging.INFO
-
-    LOGGING_CONFIG = {
-        "version": 1,
-        "disable_existing_loggers": False,
-        "formatters": {
-            "default": {
-                "()": "uvicorn.logging.DefaultFormatter",
-                "fmt": 'level=%(levelname)s message="%(message)s"',
-                "use_colors": None,
-            },
-            "access": {
-                "()": "uvicorn.logging.AccessFormatter",
-                "fmt": 'level=%(levelname)s address=%(client_addr)s request="%(request_line)s" status_code=%(status_code)s',
-            },
-            "app": {
-                "()": "logging.Formatter",
-                "fmt": "level=%(levelname)s time=%(created)f %(message)s location=%(pathname)s:%(lineno)d",
-            },
+LOGGING_CONFIG: Dict[str, Any] = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "default": {
+            "()": "uvicorn.logging.DefaultFormatter",
+            "fmt": 'level=%(levelname)s message="%(message)s"',
+            "use_colors": None,
         },
-        "handlers": {
-            "default": {
-                "formatter": "default",
-                "class": "logging.StreamHandler",
-                "stream": "ext://sys.stderr",
-            },
-            "access": {
-                "formatter": "access",
-                "class": "logging.StreamHandler",
-                "stream": "ext://sys.stdout",
-            },
-            "app": {
-                "formatter": "app",
-                "class": "logging.StreamHandler",
-                "stream": "ext://sys.stderr",
-            },
+        "access": {
+            "()": "uvicorn.logging.AccessFormatter",
+            "fmt": 'level=%(levelname)s address=%(client_addr)s request="%(request_line)s" status_code=%(status_code)s',
         },
-        "loggers": {
-            "app": {"handlers": ["app"], "level": log_level},
-            "uvicorn": {"handlers": ["default"], "level": log_level},
-            "uvicorn.error": {"level": "INFO"},
-            "uvicorn.access": {
-                "handlers": ["access"],
-                "level": log_level,
-                "propagate": False,
-            },
+        "app": {
+            "()": "logging.Formatter",
+            "fmt": "level=%(levelname)s time=%(created)f %(message)s location=%(pathname)s:%(lineno)d",
         },
-    }
+    },
+    "handlers": {
+        "default": {
+            "formatter": "default",
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stderr",
+        },
+        "access": {
+            "formatter": "access",
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stdout",
+        },
+        "app": {
+            "formatter": "app",
+            "class": "logging.StreamHandler",
+            "stream": "ext://sys.stderr",
+        },
+    },
+    "loggers": {
+        "app": {"handlers": ["app"], "level": LOG_LEVEL},
+        "uvicorn": {"handlers": ["default"], "level": LOG_LEVEL},
+        "uvicorn.error": {"level": "INFO"},
+        "uvicorn.access": {
+            "handlers": ["access"],
+            "level": LOG_LEVEL,
+            "propagate": False,
+        },
+    },
+}
 
-    logging.config.dictConfig(LOGGING_CONFIG)
 
-    class EndpointFilter(logging.Filter):
-        def filter(self, record: logging.LogRecord) -> bool:
-            return record.getMessage().find("healthz") == -1
+class EndpointFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.getMessage().find("healthz") == -1
 
-    # Filter out /healthz
-    logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
-    _APP_LOGGER_INITIALIZED = True
+logging.config.dictConfig(LOGGING_CONFIG)
+# Filter out /healthz
+logging.getLogger("uvicorn.access").addFilter(EndpointFilter())
 
-    log = logging.getLogger("app")
 
-    return log
+def get_logger() -> logging.Logger:
+    return logging.getLogger("app")
 
 
 log = get_logger()
 templates = Jinja2Templates(directory=str(settings.TEMPLATES_DIR))
+# Compiled templates are kept between restarts. Templates are only checked for
+# changes while debugging.
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+templates.env.auto_reload = settings.LOG_LEVEL == "debug"
 static = StaticFiles(directory=str(settings.STATIC_DIR))
 
 
@@ -152,6 +146,32 @@ static = StaticFiles(directory=str(settings.STATIC_DIR))
 # ¡¡func
 
 
+def stream_template(
+    name: str, context: Dict[str, Any], chunk_size: int = 64 * 1024
+) -> StreamingResponse:
+    """
+    Render a template while the response is being sent, instead of building the
+    whole page in memory first. The Jinja output is grouped in chunks to avoid
+    a threadpool round trip per template fragment.
+    """
+    template = templates.get_template(name)
+
+    def chunks():
+        buf: List[str] = []
+        size = 0
+        for part in template.generate(context):
+            buf.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield "".join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield "".join(buf)
+
+    return StreamingResponse(chunks(), media_type="text/html")
+
+
 def pp(*args, **kwargs):
     """
     Debug print.
@@ -162,49 +182,56 @@ def pp(*args, **kwargs):
 SQLiteValue = Union[str, int, float, bytes]
 
 
-class _SQLiteName(BaseModel):
-    name: str
-    _escaped_name: str = PrivateAttr()
+@functools.lru_cache(maxsize=4096)
+def _escape(name: str) -> str:
+    return f"[{name}]"
 
-    def __init__(self, **data):
-        super().__init__(**data)
-        # this could also be done with default_factory
-        self._escaped_name = f"[{self.name}]"
 
-    @validator("name", pre=True, always=True)
-    def validate_name(cls, v):
-        v = v.strip("[]")
+@dataclass(frozen=True)
+class _SQLiteName:
+    __slots__ = ("name",)
+
+    name: str
+
+    def __post_init__(self):
+        name = self.name.strip("[]")
         invalid_chars = ("[", "]", '"', "'")
-        if any(x in v for x in invalid_chars):
-            raise ValueError(f"Invalid table name: '{v}'")
-        return v
+        if any(x in name for x in invalid_chars):
+            raise ValueError(f"Invalid table name: '{name}'")
+        # The dataclass is frozen, the value has to be set this way
+        object.__setattr__(self, "name", name)
+
+    @property
+    def escaped_name(self) -> str:
+        return _escape(self.name)
 
 
 class TableName(_SQLiteName):
-    ...
+    __slots__ = ()
 
 
 class ColumnName(_SQLiteName):
-    ...
+    __slots__ = ()
 
 
-class ForeignKey(BaseModel):
+@dataclass(frozen=True)
+class ForeignKey:
+    __slots__ = ("src_table", "src_column", "ref_table", "ref_column")
+
     src_table: TableName
     src_column: ColumnName
     ref_table: TableName
     ref_column: ColumnName
 
-    @validator("ref_column")
-    def default_ref_column(cls, v):
+    def __post_init__(self):
         """
         Set default reference column if not defined
         """
-        if not v:
-            return cls.src_column
-        return v
+        if not self.ref_column:
+            object.__setattr__(self, "ref_column", self.src_column)
 
 
-class GlobalUserConfig(_BaseModel):
+class GlobalUserConfig(BaseModel):
     user_id: UUID4 = Field(default_factory=uuid4)
     ssh_host: str
     remote_sqlite_path: str
@@ -235,36 +262,261 @@ class QuerySyntaxError(Exception):
         self.query = query
 
 
+class RemoteSessionClosed(Exception):
+    pass
+
+
 class NoContent(Exception):
     pass
 
 
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        super().__init__(etag)
+
+        self.etag = etag
+
+
 SSH_SOCKET_DIR = tempfile.TemporaryDirectory(prefix="ltx", suffix="tmp-confs")
 
 # print(SSH_SOCKET_DIR.name)
 
 
-def get_params_cmd(query_params: Dict[str, SQLiteValue]) -> str:
-    cmd = [".param clear", ".param init"]
+class SSHControlRegistry:
+    """
+    Keeps track of the SSH control masters used to multiplex the connections to
+    each host. Masters are opened on first use and closed with `ssh -O exit` when
+    they have been idle for `idle_ttl` seconds or when more than `maxsize` hosts
+    are in use.
+    """
 
-    for param_name, value in query_params.items():
-        _c = f'.param set :{param_name} "{value!r}"'
-        cmd.append(_c)
+    def __init__(
+        self,
+        maxsize: int = 32,
+        idle_ttl: float = 300.0,
+        sweep_interval: float = 60.0,
+        connect_timeout: float = 15.0,
+    ):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.connect_timeout = connect_timeout
+        self.last_used: "OrderedDict[str, float]" = OrderedDict()
+        # One lock per host, so a slow host doesn't hold back the others. They
+        # are created on first use, the registry is instantiated before the
+        # event loop.
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._sweeper: Optional["asyncio.Task[None]"] = None
+
+    def socket_path(self, ssh_host: str) -> str:
+        return f"{SSH_SOCKET_DIR.name}/{ssh_host}.socket"
+
+    def ssh_options(self, ssh_host: str) -> List[str]:
+        options = [
+            "-o",
+            "ControlPersist=5m",
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.socket_path(ssh_host)}",
+            # Detect dead connections instead of hanging on them
+            "-o",
+            f"ConnectTimeout={int(self.connect_timeout)}",
+            "-o",
+            "ServerAliveInterval=15",
+        ]
+        if settings.SSH_COMPRESSION:
+            # Compression is negotiated by the control master, the multiplexed
+            # commands use whatever the master connection uses.
+            options += ["-o", "Compression=yes"]
+        return options
+
+    async def acquire(self, ssh_host: str) -> List[str]:
+        """
+        Mark `ssh_host` as used, opening its control master if needed, and return
+        the SSH options to connect through it.
+        """
+        if ssh_host not in self.last_used:
+            lock = self._locks.get(ssh_host)
+            if lock is None:
+                lock = self._locks[ssh_host] = asyncio.Lock()
+            async with lock:
+                if ssh_host not in self.last_used:
+                    await self._open(ssh_host)
+                    self.last_used[ssh_host] = time.monotonic()
+                    while len(self.last_used) > self.maxsize:
+                        await self.release(next(iter(self.last_used)))
+
+        self.last_used[ssh_host] = time.monotonic()
+        self.last_used.move_to_end(ssh_host)
+        return self.ssh_options(ssh_host)
+
+    async def release(self, ssh_host: str):
+        self.last_used.pop(ssh_host, None)
+        await close_sessions(ssh_host)
+        await self._control(ssh_host, "exit")
+
+    async def release_all(self):
+        for ssh_host in list(self.last_used):
+            await self.release(ssh_host)
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self.release_all()
+
+    async def _open(self, ssh_host: str):
+        if await self._control(ssh_host, "check"):
+            return
+
+        log.debug(f"Opening SSH control master for {ssh_host}")
+        # `-f` keeps the master running in the background, its output must not
+        # be piped or we would wait on it forever.
+        proc = await asyncio.create_subprocess_exec(
+            "ssh",
+            "-M",
+            "-N",
+            "-f",
+            *self.ssh_options(ssh_host),
+            ssh_host,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            # `ConnectTimeout` doesn't cover a server that hangs after connecting
+            returncode = await asyncio.wait_for(proc.wait(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            returncode = None
+        if returncode != 0:
+            # Commands will still try to open the master themselves
+            log.warning(f"Could not open SSH control master for {ssh_host}")
+
+    async def _control(self, ssh_host: str, command: str) -> bool:
+        proc = await asyncio.create_subprocess_exec(
+            "ssh",
+            "-O",
+            command,
+            "-o",
+            f"ControlPath={self.socket_path(ssh_host)}",
+            ssh_host,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        return await proc.wait() == 0
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            # Sessions are per DB, one can sit idle while its host is still in use
+            await close_idle_sessions(self.idle_ttl)
+            now = time.monotonic()
+            for ssh_host, last_used in list(self.last_used.items()):
+                if now - last_used > self.idle_ttl:
+                    log.debug(f"Closing idle SSH control master for {ssh_host}")
+                    await self.release(ssh_host)
+
+
+SSH_CONTROL = SSHControlRegistry()
+
+
+def sqlite_literal(value: SQLiteValue) -> str:
+    """
+    SQL literal for `value`.
+    """
+    if isinstance(value, bytes):
+        return f"x'{value.hex()}'"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + value.replace("'", "''") + "'"
+
+
+def get_params_cmd(params: Dict[str, str], bound: Dict[str, str]) -> str:
+    """
+    CLI commands to go from the `bound` parameters to `params`. Both map parameter
+    names to SQL literals, parameters that didn't change are not sent again.
+    """
+    cmd = [f".param unset :{name}" for name in bound if name not in params]
+
+    for param_name, literal in params.items():
+        if bound.get(param_name) == literal:
+            continue
+        # The CLI argument is double quoted, it can't contain raw newlines
+        arg = literal.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        cmd.append(f'.param set :{param_name} "{arg}"')
 
     return "\n".join(cmd)
 
 
-def p_query(query: str, query_params: Dict[str, SQLiteValue]) -> str:
-    return get_params_cmd(query_params) + "\n" + query
+# Results of queries that only depend on the DB schema (tables, foreign keys) are
+# cached while the remote `PRAGMA schema_version` doesn't change.
+SCHEMA_CACHE_TTL = 60.0
+SCHEMA_VERSION_TTL = 5.0
 
+_SCHEMA_VERSIONS: Dict[Tuple[str, str], Tuple[float, int]] = {}
+_SCHEMA_CACHE: Dict[
+    Tuple[str, str, str], Tuple[float, int, List[Dict[str, SQLiteValue]]]
+] = {}
+
+
+async def get_schema_version(
+    *, ssh_host: str, remote_sqlite_path: str, remote_sqlite_bin: str
+) -> int:
+    key = (ssh_host, remote_sqlite_path)
+    cached = _SCHEMA_VERSIONS.get(key)
+    if cached and time.monotonic() - cached[0] < SCHEMA_VERSION_TTL:
+        return cached[1]
+
+    data, timeout = await arun(
+        ssh_host=ssh_host,
+        cmd="PRAGMA schema_version",
+        remote_sqlite_db=remote_sqlite_path,
+        remote_sqlite_bin=remote_sqlite_bin,
+    )
+
+    if timeout:
+        # TODO: Improve error message
+        raise QueryTimeoutError("Timeout")
+
+    schema_version = int(data[0]["schema_version"]) if data else 0
+    _SCHEMA_VERSIONS[key] = (time.monotonic(), schema_version)
+    return schema_version
 
-async def get_table_fks(
-    tname: TableName, *, ssh_host: str, remote_sqlite_path: str, remote_sqlite_bin: str
-) -> Optional[Tuple[ForeignKey, ...]]:
 
-    fks, timeout = await arun(
+async def schema_query(
+    cmd: str, *, ssh_host: str, remote_sqlite_path: str, remote_sqlite_bin: str
+) -> List[Dict[str, SQLiteValue]]:
+    """
+    Run a query whose results only change when the schema does, reusing cached
+    results when possible.
+    """
+    schema_version = await get_schema_version(
         ssh_host=ssh_host,
-        cmd=f"PRAGMA foreign_key_list({tname._escaped_name})",
+        remote_sqlite_path=remote_sqlite_path,
+        remote_sqlite_bin=remote_sqlite_bin,
+    )
+
+    key = (ssh_host, remote_sqlite_path, cmd)
+    cached = _SCHEMA_CACHE.get(key)
+    if cached:
+        cached_at, cached_version, cached_data = cached
+        if (
+            cached_version == schema_version
+            and time.monotonic() - cached_at < SCHEMA_CACHE_TTL
+        ):
+            return cached_data
+
+    data, timeout = await arun(
+        ssh_host=ssh_host,
+        cmd=cmd,
         remote_sqlite_db=remote_sqlite_path,
         remote_sqlite_bin=remote_sqlite_bin,
     )
@@ -273,6 +525,70 @@ async def get_table_fks(
         # TODO: Improve error message
         raise QueryTimeoutError("Timeout")
 
+    _SCHEMA_CACHE[key] = (time.monotonic(), schema_version, data)
+    return data
+
+
+# `PRAGMA data_version` changes when another connection modifies the DB. It's
+# checked at most every DATA_VERSION_TTL seconds to build the HTTP ETags.
+DATA_VERSION_TTL = 2.0
+
+_DATA_VERSIONS: Dict[Tuple[str, str], Tuple[float, str]] = {}
+
+# The session generations restart with the process, and so does `data_version`
+# on every new connection. Without this, a restarted app could hand out the same
+# token for a different state of the DB.
+_DATA_VERSION_NONCE = uuid4().hex
+
+
+async def get_data_version(
+    *, ssh_host: str, remote_sqlite_path: str, remote_sqlite_bin: str
+) -> str:
+    """
+    Token that changes whenever the remote DB is modified. The values of
+    `PRAGMA data_version` are only comparable within the same connection, so the
+    remote session generation (and the process it belongs to) is part of it.
+    """
+    key = (ssh_host, remote_sqlite_path)
+    cached = _DATA_VERSIONS.get(key)
+    if cached and time.monotonic() - cached[0] < DATA_VERSION_TTL:
+        return cached[1]
+
+    # The generation must come from the same locked call as the rows: the session
+    # could be restarted by another request right after it
+    data, timeout, generation = await _arun(
+        ssh_host=ssh_host,
+        cmd="PRAGMA data_version",
+        remote_sqlite_db=remote_sqlite_path,
+        remote_sqlite_bin=remote_sqlite_bin,
+    )
+
+    if timeout:
+        # TODO: Improve error message
+        raise QueryTimeoutError("Timeout")
+
+    version = int(data[0]["data_version"]) if data else 0
+    data_version = f"{_DATA_VERSION_NONCE}.{generation}.{version}"
+    _DATA_VERSIONS[key] = (time.monotonic(), data_version)
+    return data_version
+
+
+async def get_table_fks(
+    tname: TableName, *, ssh_host: str, remote_sqlite_path: str, remote_sqlite_bin: str
+) -> Optional[Tuple[ForeignKey, ...]]:
+
+    # The foreign keys of all the tables are fetched (and cached) in one go
+    all_fks = await schema_query(
+        "select m.name as src_table, f.* from sqlite_master as m, "
+        "pragma_foreign_key_list(m.name) as f where m.type = 'table'",
+        ssh_host=ssh_host,
+        remote_sqlite_path=remote_sqlite_path,
+        remote_sqlite_bin=remote_sqlite_bin,
+    )
+
+    # SQLite table names are case insensitive
+    fks = [x for x in all_fks if str(x["src_table"]).lower() == tname.name.lower()]
+
     if not fks:
         return None
 
@@ -287,51 +603,396 @@ async def get_table_fks(
     )
 
 
-def validate_remote_sqlite_cli(ssh_host: str, remote_sqlite_bin: str):
+async def validate_remote_sqlite_cli(ssh_host: str, remote_sqlite_bin: str):
 
-    p = subprocess.run(
-        [
+    async with ssh_semaphore(ssh_host):
+        proc = await asyncio.create_subprocess_exec(
             "ssh",
-            "-o",
-            "ControlPersist=5m",
-            "-o",
-            "ControlMaster=auto",
-            "-o",
-            f"ControlPath={SSH_SOCKET_DIR.name}/{ssh_host}.socket",
+            *await SSH_CONTROL.acquire(ssh_host),
             ssh_host,
             f"{remote_sqlite_bin} -json -version",
-        ],
-        text=True,
-        capture_output=True,
-    )
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _stdout, _stderr = await proc.communicate()
+    stdout, stderr = _stdout.decode(), _stderr.decode()
 
-    if p.returncode == 0:
+    if proc.returncode == 0:
         return
 
-    if "Error: unknown option: -json" in p.stderr:
+    if "Error: unknown option: -json" in stderr:
         raise RemoteSqliteBinError(
             f"The remote SQLite binary '{remote_sqlite_bin}' doesn't support the -json flag. "
             "Please choose or install a version of the SQLite CLI which supports the -json flag."
         )
 
     else:
-        print(p.stderr)
-        print(p.stdout)
+        print(stderr)
+        print(stdout)
         raise RemoteSqliteBinError(
             f"An unexpected error happened while trying to validate the remote "
             f"SQLite binary '{remote_sqlite_bin}'."
         )
 
 
-# The `arun` function has been adapted from a similar function in datasette-ripgrep
+# Line printed by the remote CLI after every command batch. A JSON line can never
+# be equal to it, so it safely marks the end of the results.
+SESSION_EOF = "__LTX_EOF__"
+_SESSION_EOF_LINE = f"\n{SESSION_EOF}\n".encode()
+# Location in the CLI error messages, e.g. "Parse error near line 31: ..." or
+# "Error: near line 31: ..." in older versions
+_SESSION_ERROR_LINE = re.compile(r"^(\w+ error|Error):? near line \d+:", re.MULTILINE)
+
+# Run by the remote CLI before reading any command. A 64 MiB page cache and a
+# 256 MiB memory map let repeated scans of large tables hit memory instead of
+# issuing a read per page. `mmap_size` prints its new value, which ends up in the
+# output of the session health check.
+REMOTE_SQLITE_PRAGMAS = (
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def parse_json_rows(
+    data: bytes, max_lines: Optional[int] = None
+) -> List[Dict[str, SQLiteValue]]:
+    """
+    Parse the output of `sqlite3 -json`. Each statement prints its own array, with
+    one row per line, so they are merged into a single array before parsing. If
+    `max_lines` is set, only the rows in the first `max_lines` lines are parsed.
+    """
+    if max_lines is not None:
+        data = b"\n".join(data.split(b"\n", max_lines)[:max_lines]).rstrip(b",\n")
+        if data and not data.endswith(b"]"):
+            data += b"]"
+
+    data = data.strip()
+    if not data:
+        return []
+
+    try:
+        rows = orjson.loads(data.replace(b"]\n[", b","))
+    except orjson.JSONDecodeError:
+        log.error(f"Error decoding JSON output: {data[:1000]!r}")
+        raise
+    if not isinstance(rows, list):
+        # e.g. `.mode csv` printing a single number
+        log.error(f"Unexpected JSON output: {data[:1000]!r}")
+        raise ValueError("The output is not a list of rows")
+    return cast(List[Dict[str, SQLiteValue]], rows)
+
+
+# The `RemoteSqliteSession.execute` method has been adapted from the `arun`
+# function in datasette-ripgrep
 # https://github.com/simonw/datasette-ripgrep/blob/883df3abf96eaba52f6c30ad664698b9c45cb19a/datasette_ripgrep/__init__.py#L9
 # datasette-ripgrep is under Apache 2.0 license.
 # https://tldrlegal.com/license/apache-license-2.0-(apache-2.0)
 # The changes to the function include:
 # * Different subprocess
 # * Passing stdin to the subprocess
+# * The subprocess is long-lived and each batch of results ends with a sentinel line
+# * The output is read in chunks and parsed at once
 # * Raise JSON decoding errors
 # * Some extra logging messages specific to `litexplore`
+class RemoteSqliteSession:
+    """
+    Long-lived SQLite CLI process running on the remote host.
+
+    Commands are streamed to its stdin one batch at a time, so the SSH handshake,
+    the remote process launch and the DB open are paid once instead of on every
+    query. The CLI runs with `-bail`, so any error makes it exit; the session is
+    then respawned on the next command.
+    """
+
+    def __init__(
+        self,
+        ssh_host: str,
+        remote_sqlite_db: str,
+        remote_sqlite_bin: str,
+        write_query: bool = False,
+    ):
+        self.ssh_host = ssh_host
+        self.remote_sqlite_db = remote_sqlite_db
+        self.remote_sqlite_bin = remote_sqlite_bin
+        self.write_query = write_query
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.lock = asyncio.Lock()
+        # stderr is drained while the session runs so the pipe never fills up.
+        # It's kept for the whole life of the process, see `_raise_remote_error`.
+        self.stderr = bytearray()
+        self._stderr_task: Optional["asyncio.Task[None]"] = None
+        # Parameters currently bound in the CLI, as SQL literals
+        self.params: Dict[str, str] = {}
+        # Changes every time the remote process is (re)started
+        self.generation = 0
+        self.last_used = time.monotonic()
+        # Set when the session is removed from `REMOTE_SESSIONS`, it must not be
+        # restarted after that or nothing would ever close it.
+        self.closed = False
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        open_mode = "?mode=ro"
+        if self.write_query:
+            open_mode = ""
+
+        cmd_flags = " ".join(f'-cmd "{pragma}"' for pragma in REMOTE_SQLITE_PRAGMAS)
+        args = [
+            *SSH_CONTROL.ssh_options(self.ssh_host),
+            self.ssh_host,
+            f"{self.remote_sqlite_bin} -json -bail {cmd_flags} "
+            f"file://{self.remote_sqlite_db}{open_mode}",
+        ]
+        log.debug(f"Starting remote SQLite session on {self.ssh_host}")
+        self.proc = await asyncio.create_subprocess_exec(
+            "ssh",
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # limit=1024 * 1024, # Use this to change the buffer size
+        )
+        self.stderr.clear()
+        self._stderr_task = asyncio.create_task(self._drain_stderr())
+        self.params = {}
+        self.generation = next(_SESSION_GENERATIONS)
+
+        # Health check, the remote DB is only opened when the first query runs
+        try:
+            health, _ = await self._execute(
+                "PRAGMA schema_version", max_lines=len(REMOTE_SQLITE_PRAGMAS) + 2
+            )
+        except QuerySyntaxError:
+            health = []
+        if not any("schema_version" in row for row in health):
+            await self.close()
+            raise RemoteSqliteBinError(
+                f"Could not open the remote SQLite database '{self.remote_sqlite_db}' "
+                f"on '{self.ssh_host}'."
+            )
+
+    async def close(self, grace_period: float = 2.0):
+        """
+        Stop the remote CLI. Killing the local `ssh` right away would leave the
+        remote process running, so it's first asked to finish: stdin is closed
+        and `ssh` gets a SIGTERM. It's only killed if it doesn't exit in time.
+        """
+        if not self.alive:
+            return
+        assert self.proc and self.proc.stdin
+        self.proc.stdin.close()
+        try:
+            self.proc.terminate()
+            await asyncio.wait_for(self.proc.wait(), grace_period)
+        except OSError:
+            # Ignore 'no such process' error
+            pass
+        except asyncio.TimeoutError:
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+            await self.proc.wait()
+        if self._stderr_task is not None:
+            self._stderr_task.cancel()
+
+    async def execute(
+        self,
+        cmd: str,
+        max_lines: int,
+        query_params: Optional[Dict[str, SQLiteValue]] = None,
+    ) -> Tuple[List[Dict[str, SQLiteValue]], bool, int]:
+        """
+        Run `cmd` with `query_params` bound and return its rows, whether
+        `max_lines` was hit and the generation of the process that ran it.
+        """
+        # The extra `;` completes the last statement in case it wasn't terminated.
+        # An unterminated string or comment would swallow the sentinel instead.
+        # Nothing has been sent yet, so the session can still be used.
+        if not sqlite3.complete_statement(f"{cmd}\n;"):
+            raise QuerySyntaxError(f"Incomplete SQL statement: {cmd}", query=cmd)
+
+        async with self.lock:
+            if self.closed:
+                raise RemoteSessionClosed
+            try:
+                if not self.alive:
+                    await self.start()
+                results, max_lines_hit = await self._execute(
+                    cmd, max_lines, query_params or {}
+                )
+            except BaseException:
+                # The output is out of sync with the commands (timeout, bad JSON...).
+                # The cleanup must finish even if the request is cancelled again.
+                await asyncio.shield(self.close())
+                raise
+            finally:
+                self.last_used = time.monotonic()
+            return results, max_lines_hit, self.generation
+
+    async def _execute(
+        self,
+        cmd: str,
+        max_lines: int,
+        query_params: Optional[Dict[str, SQLiteValue]] = None,
+    ) -> Tuple[List[Dict[str, SQLiteValue]], bool]:
+        assert self.proc and self.proc.stdin and self.proc.stdout
+        params = {
+            name: sqlite_literal(value) for name, value in (query_params or {}).items()
+        }
+        params_cmd = get_params_cmd(params, self.params)
+        try:
+            if params_cmd:
+                self.proc.stdin.write(f"{params_cmd}\n".encode())
+            self.params = params
+            # `.output` makes sure the sentinel goes to stdout even if `cmd`
+            # redirected the output
+            self.proc.stdin.write(f"{cmd}\n;\n.output\n.print {SESSION_EOF}\n".encode())
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # The CLI exited before reading the commands (bad binary or DB, the
+            # connection dropped since the last command...)
+            await self._raise_remote_error(cmd)
+
+        buf = bytearray()
+        nlines = 0
+        while True:
+            chunk = await self.proc.stdout.read(65536)
+            if not chunk:
+                # The CLI exited because of an error (`-bail`)
+                await self._raise_remote_error(cmd)
+                break
+            buf += chunk
+            if buf.endswith(_SESSION_EOF_LINE) or buf == _SESSION_EOF_LINE[1:]:
+                del buf[-len(_SESSION_EOF_LINE) + 1 :]
+                break
+            nlines += chunk.count(b"\n")
+            if nlines >= max_lines:
+                log.warning("Subprocess max lines hit")
+                # The rest of the output is not read, start over next time
+                await self.close()
+                return self._parse(bytes(buf), cmd, max_lines), True
+
+        results = self._parse(bytes(buf), cmd)
+        if len(results) > max_lines:
+            log.warning("Subprocess max lines hit")
+            return results[:max_lines], True
+        return results, False
+
+    def _parse(
+        self, data: bytes, cmd: str, max_lines: Optional[int] = None
+    ) -> List[Dict[str, SQLiteValue]]:
+        try:
+            return parse_json_rows(data, max_lines)
+        except ValueError:
+            # `orjson.JSONDecodeError` is a `ValueError` too
+            raise QuerySyntaxError(
+                "The output of the command is not JSON, the output mode of the "
+                "SQLite CLI can't be changed.",
+                query=cmd,
+            )
+
+    async def _drain_stderr(self):
+        assert self.proc and self.proc.stderr
+        while True:
+            chunk = await self.proc.stderr.read(65536)
+            if not chunk:
+                break
+            log.debug(f"Remote SQLite stderr: {chunk!r}")
+            # Only the latest messages are relevant
+            self.stderr += chunk
+            del self.stderr[:-65536]
+
+    async def _raise_remote_error(self, cmd: str):
+        assert self.proc and self._stderr_task
+        await self.proc.wait()
+        # The process exited, the drain ends once the pipe is empty. It may have
+        # been cancelled by `close` already, that must not cancel the caller.
+        await asyncio.wait({self._stderr_task})
+        message = bytes(self.stderr).decode(errors="replace")
+        errors = list(_SESSION_ERROR_LINE.finditer(message))
+        if errors:
+            # stderr is not split by command, but with `-bail` the last error is
+            # the one that stopped the CLI. Its line number counts every command
+            # sent to the session, not just `cmd`, so it's dropped.
+            message = message[errors[-1].start() :]
+            raise QuerySyntaxError(_SESSION_ERROR_LINE.sub(r"\1:", message), query=cmd)
+        log.error(f"Remote SQLite session exited: {message}")
+        # The command has been sent, so it's most likely the cause (e.g. an unknown
+        # dot command). A broken setup is caught by the health check in `start`.
+        raise QuerySyntaxError(
+            message[-1000:].strip()
+            or f"The remote SQLite process on '{self.ssh_host}' exited unexpectedly.",
+            query=cmd,
+        )
+
+
+_SESSION_GENERATIONS = itertools.count(1)
+
+REMOTE_SESSIONS: Dict[Tuple[str, str, str, bool], RemoteSqliteSession] = {}
+
+
+def get_session(
+    ssh_host: str, remote_sqlite_db: str, remote_sqlite_bin: str, write_query: bool
+) -> RemoteSqliteSession:
+    key = (ssh_host, remote_sqlite_db, remote_sqlite_bin, write_query)
+    session = REMOTE_SESSIONS.get(key)
+    if session is None:
+        session = RemoteSqliteSession(*key)
+        REMOTE_SESSIONS[key] = session
+    return session
+
+
+async def close_sessions(ssh_host: Optional[str] = None):
+    """
+    Close the sessions to `ssh_host`, or all of them if no host is given.
+    """
+    for key, session in list(REMOTE_SESSIONS.items()):
+        if ssh_host is None or session.ssh_host == ssh_host:
+            await _close_session(key, session)
+
+
+async def close_idle_sessions(idle_ttl: float):
+    """
+    Close the sessions that haven't run any command in the last `idle_ttl`
+    seconds.
+    """
+    now = time.monotonic()
+    for key, session in list(REMOTE_SESSIONS.items()):
+        if not session.lock.locked() and now - session.last_used > idle_ttl:
+            log.debug(f"Closing idle remote SQLite session {key}")
+            await _close_session(key, session)
+
+
+async def _close_session(key: Tuple[str, str, str, bool], session: RemoteSqliteSession):
+    if REMOTE_SESSIONS.get(key) is not session:
+        return
+    del REMOTE_SESSIONS[key]
+    session.closed = True
+    # A running command is left to finish, its output would be cut short
+    async with session.lock:
+        await session.close()
+
+
+# Max. number of queries running at the same time on each SSH host. Without a
+# limit, a burst of requests (e.g. infinite scroll) can spawn lots of remote
+# processes and overload the SSH control master.
+MAX_SSH_QUERIES_PER_HOST = 8
+
+_SSH_SEMAPHORES: Dict[str, asyncio.Semaphore] = {}
+
+
+def ssh_semaphore(ssh_host: str) -> asyncio.Semaphore:
+    sem = _SSH_SEMAPHORES.get(ssh_host)
+    if sem is None:
+        sem = _SSH_SEMAPHORES[ssh_host] = asyncio.Semaphore(MAX_SSH_QUERIES_PER_HOST)
+    return sem
+
+
 async def arun(
     ssh_host: str,
     cmd: str,
@@ -340,107 +1001,81 @@ async def arun(
     write_query: bool = False,
     time_limit=60.0,
     max_lines=2000,
+    query_params: Optional[Dict[str, SQLiteValue]] = None,
+    private_session: bool = False,
 ) -> Tuple[List[Dict[str, Union[str, int, float, bytes]]], bool]:
+    results, time_limit_hit, _ = await _arun(
+        ssh_host,
+        cmd,
+        remote_sqlite_db,
+        remote_sqlite_bin,
+        write_query=write_query,
+        time_limit=time_limit,
+        max_lines=max_lines,
+        query_params=query_params,
+        private_session=private_session,
+    )
+    return results, time_limit_hit
 
+
+async def _arun(
+    ssh_host: str,
+    cmd: str,
+    remote_sqlite_db: str,
+    remote_sqlite_bin: str,
+    write_query: bool = False,
+    time_limit=60.0,
+    max_lines=2000,
+    query_params: Optional[Dict[str, SQLiteValue]] = None,
+    private_session: bool = False,
+) -> Tuple[List[Dict[str, Union[str, int, float, bytes]]], bool, int]:
+    """
+    Same as `arun`, also returning the generation of the remote session that ran
+    the command (0 if the time limit was hit).
+
+    With `private_session`, the command runs in its own remote session, closed
+    right after. Use it for arbitrary user input: dot commands, `ATTACH`... change
+    the state of the CLI and must not leak into the shared sessions.
+    """
     log.debug(f"Running command: {cmd}")
 
-    open_mode = "?mode=ro"
-    if write_query:
-        open_mode = ""
-
-    args = [
-        "-o",
-        "ControlPersist=5m",
-        "-o",
-        "ControlMaster=auto",
-        "-o",
-        f"ControlPath={SSH_SOCKET_DIR.name}/{ssh_host}.socket",
-        ssh_host,
-        f"{remote_sqlite_bin} -json file://{remote_sqlite_db}{open_mode}",
-    ]
-    proc = await asyncio.create_subprocess_exec(
-        "ssh",
-        *args,
-        stdout=asyncio.subprocess.PIPE,
-        stdin=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-        # limit=1024 * 1024, # Use this to change the buffer size
-    )
-    assert proc.stdin
-    proc.stdin.write(cmd.encode())
-    proc.stdin.write_eof()
-    max_lines_hit = False
+    await SSH_CONTROL.acquire(ssh_host)
     time_limit_hit = False
+    generation = 0
 
-    if proc.returncode != 0:
-        assert proc.stderr
-
-        data = await proc.stderr.read()
-        pp(data)
-        if b"Parse error" in data:
-            raise QuerySyntaxError(data.decode(), query=cmd)
+    results: List[Dict[str, Union[str, int, float, bytes]]] = []
 
-    async def inner(results):
-        nonlocal max_lines_hit
+    async with ssh_semaphore(ssh_host):
         while True:
+            if private_session:
+                session = RemoteSqliteSession(
+                    ssh_host, remote_sqlite_db, remote_sqlite_bin, write_query
+                )
+            else:
+                session = get_session(
+                    ssh_host, remote_sqlite_db, remote_sqlite_bin, write_query
+                )
             try:
-                assert proc.stdout
-                line = await proc.stdout.readline()
-            except (asyncio.exceptions.LimitOverrunError, ValueError) as e:
-                log.exception(str(e))
-                # Skip 'Separator is not found, and chunk exceed the limit' lines
+                results, _, generation = await asyncio.wait_for(
+                    session.execute(cmd, max_lines, query_params), timeout=time_limit
+                )
+            except RemoteSessionClosed:
+                # Closed while waiting for it (e.g. evicted), use a new one
                 continue
-            if line == b"":
-                break
-            try:
-                results.append(json.loads(line.strip(b"[],\n")))
-            except json.decoder.JSONDecodeError:
-                log.error(f"Error decoding JSON line: {line}")
-                raise
-            if len(results) >= max_lines:
-                log.warning("Subprocess max lines hit")
-                max_lines_hit = True
-                break
-
-    results: List[Dict[str, Union[str, int, float, bytes]]] = []
-
-    try:
-        await asyncio.wait_for(inner(results), timeout=time_limit)
-    except asyncio.TimeoutError:
-        time_limit_hit = True
-    try:
-        proc.kill()
-    except OSError:
-        # Ignore 'no such process' error
-        pass
-    # We should have accumulated some results anyway
-    return results, time_limit_hit
-
+            except asyncio.TimeoutError:
+                time_limit_hit = True
+            finally:
+                if private_session:
+                    session.closed = True
+                    await asyncio.shield(session.close())
+            break
 
-def run(ssh_host: str, cmd: str, remote_sqlite_db: str, remote_sqlite_bin: str):
-
-    p = subprocess.run(
-        [
-            "ssh",
-            "-o",
-            "ControlPersist=5m",
-            "-o",
-            "ControlMaster=auto",
-            "-o",
-            f"ControlPath={SSH_SOCKET_DIR.name}/{ssh_host}.socket",
-            ssh_host,
-            f"{remote_sqlite_bin} -json file://{remote_sqlite_db}?mode=ro",
-        ],
-        text=True,
-        capture_output=True,
-        input=cmd,
-        check=True,
-    )
-
-    if not p.stdout.strip():
-        return None
+    if write_query:
+        # Don't wait for the caches to expire to see the changes
+        _DATA_VERSIONS.pop((ssh_host, remote_sqlite_db), None)
+        _SCHEMA_VERSIONS.pop((ssh_host, remote_sqlite_db), None)
 
-    return json.loads(p.stdout.strip())
+    return results, time_limit_hit, generation
 
 
 # ¡¡app
@@ -452,7 +1087,35 @@ async def conf_cookie(
     if not ltx_conf:
         raise MissingConf
 
-    return GlobalUserConfig.parse_raw(ltx_conf)
+    return GlobalUserConfig.parse_obj(orjson.loads(ltx_conf))
+
+
+async def data_etag(
+    request: Request,
+    conf: GlobalUserConfig = Depends(conf_cookie),
+    hx_request: Optional[str] = Header(None, include_in_schema=False),
+) -> str:
+    """
+    ETag for pages that only depend on the remote data. If the client already has
+    the current version, the request stops here with a 304.
+    """
+    data_version = await get_data_version(
+        ssh_host=conf.ssh_host,
+        remote_sqlite_path=conf.remote_sqlite_path,
+        remote_sqlite_bin=conf.remote_sqlite_bin,
+    )
+    key = (
+        f"{data_version}:{conf.ssh_host}:{conf.remote_sqlite_path}:"
+        f"{conf.remote_sqlite_bin}:{conf.num_rows_display}:{bool(hx_request)}:"
+        f"{request.url.path}?{request.url.query}"
+    )
+    etag = f'"{hashlib.blake2b(key.encode(), digest_size=16).hexdigest()}"'
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (x.strip() for x in if_none_match.split(",")):
+        raise NotModified(etag)
+
+    return etag
 
 
 app = FastAPI(title="litexplore")
@@ -503,6 +1166,15 @@ async def query_syntax_exception_handler(
     return response
 
 
+@app.exception_handler(NotModified)
+async def not_modified_exception_handler(
+    request: Request, exc: NotModified
+) -> Response:
+    response = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+    response.headers["ETag"] = exc.etag
+    return response
+
+
 @app.exception_handler(NoContent)
 async def no_content_exception_handler(request: Request, exc: NoContent) -> Response:
     response = Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -535,7 +1207,9 @@ async def start_form(
     sqlite_remote_bin: str = Form(default="sqlite3"),
 ):
 
-    validate_remote_sqlite_cli(ssh_host=ssh_host, remote_sqlite_bin=sqlite_remote_bin)
+    await validate_remote_sqlite_cli(
+        ssh_host=ssh_host, remote_sqlite_bin=sqlite_remote_bin
+    )
 
     new_user_conf = GlobalUserConfig(
         ssh_host=ssh_host,
@@ -563,33 +1237,49 @@ async def health(response: Response) -> Any:
 
 
 @app.get("/tables")
-async def tables(request: Request, conf: GlobalUserConfig = Depends(conf_cookie)):
+async def tables(
+    request: Request,
+    conf: GlobalUserConfig = Depends(conf_cookie),
+    etag: str = Depends(data_etag),
+):
 
-    data, timeout = await arun(
+    data = await schema_query(
+        "select name from sqlite_master where type in ('table', 'view') and tbl_name != 'sqlite_sequence'",
         ssh_host=conf.ssh_host,
-        cmd="select name from sqlite_master where type in ('table', 'view') and tbl_name != 'sqlite_sequence'",
-        remote_sqlite_db=conf.remote_sqlite_path,
+        remote_sqlite_path=conf.remote_sqlite_path,
         remote_sqlite_bin=conf.remote_sqlite_bin,
     )
 
-    if timeout:
-        # TODO: Improve error message
-        raise QueryTimeoutError("Timeout")
-
     tables = [x["name"] for x in data] if data else []
 
     response = templates.TemplateResponse(
         "tables.html", {"request": request, "tables": tables}
     )
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
     return response
 
 
-def generate_fk_link(ref_table: TableName, ref_column: ColumnName, value: SQLiteValue):
-    # {escape(value)}
-    _filt = f"{ref_column._escaped_name} = :value"
+def get_columns(data: List[Dict[str, SQLiteValue]]) -> List[str]:
+    """
+    Column names of a list of rows, in order of appearance. Rows coming from
+    different statements may have different columns.
+    """
+    return list(dict.fromkeys(itertools.chain.from_iterable(data)))
+
+
+# Names accepted for the `qp_*` query parameters
+_PARAM_NAME = re.compile(r"\w+")
+
+
+def generate_fk_link_prefix(ref_table: TableName, ref_column: ColumnName) -> str:
+    """
+    Link to the rows of `ref_table` referenced by a foreign key, without the
+    value. The (URL encoded) value has to be appended to it.
+    """
+    _filt = f"{ref_column.escaped_name} = :value"
     filt = urllib.parse.quote(_filt)
-    q = f"/view-table?tname={urllib.parse.quote(ref_table.name)}&q={filt}&qp_value={value!r}"
-    return q
+    return f"/view-table?tname={urllib.parse.quote(ref_table.name)}&q={filt}&qp_value="
 
 
 @app.get("/view-table")
@@ -600,15 +1290,24 @@ async def view_table(
     q: Optional[str] = None,
     conf: GlobalUserConfig = Depends(conf_cookie),
     hx_request: Optional[str] = Header(None, include_in_schema=False),
+    etag: str = Depends(data_etag),
 ):
 
     table = TableName(name=tname)
 
-    query_params = {
-        pname.lstrip("qp_"): pvalue
-        for pname, pvalue in request.query_params.items()
+    query_params: Dict[str, SQLiteValue] = {
+        pname[3:]: pvalue
+        for pname, pvalue in request.query_params.multi_items()
         if pname.startswith("qp_")
     }
+    for pname in query_params:
+        # The names are sent as is in the `.param set` commands
+        if not _PARAM_NAME.fullmatch(pname):
+            raise QuerySyntaxError(
+                "Query parameter names can only contain letters, digits and "
+                "underscores.",
+                query=q or "",
+            )
 
     query_params["limit"] = (
         page * conf.num_rows_display if page else conf.num_rows_display
@@ -623,49 +1322,47 @@ async def view_table(
         filt = f"where {q} "
     _cmd = f"select * from {table.name} {filt} limit :limit offset :offset"
 
-    table_fks = await get_table_fks(
-        table,
-        ssh_host=conf.ssh_host,
-        remote_sqlite_path=conf.remote_sqlite_path,
-        remote_sqlite_bin=conf.remote_sqlite_bin,
-    )
-    fks_data = {}
-
-    if table_fks:
-        fks_data = {
-            foreign_key.src_column.name: foreign_key for foreign_key in table_fks
-        }
-
-    cmd = p_query(_cmd, query_params)
-
-    data, timeout = await arun(
-        ssh_host=conf.ssh_host,
-        cmd=cmd,
-        remote_sqlite_db=conf.remote_sqlite_path,
-        remote_sqlite_bin=conf.remote_sqlite_bin,
+    # Both queries are independent, send them at the same time
+    table_fks, (data, timeout) = await asyncio.gather(
+        get_table_fks(
+            table,
+            ssh_host=conf.ssh_host,
+            remote_sqlite_path=conf.remote_sqlite_path,
+            remote_sqlite_bin=conf.remote_sqlite_bin,
+        ),
+        arun(
+            ssh_host=conf.ssh_host,
+            cmd=_cmd,
+            remote_sqlite_db=conf.remote_sqlite_path,
+            remote_sqlite_bin=conf.remote_sqlite_bin,
+            query_params=query_params,
+        ),
     )
 
     if timeout:
         # TODO: Improve error message
         raise QueryTimeoutError("Timeout")
 
-    if not data:
-        data = [{}]
+    fks_data = {}
 
-    table_dict = defaultdict(list)
-    nrows = 0
+    if table_fks:
+        fks_data = {
+            foreign_key.src_column.name: foreign_key for foreign_key in table_fks
+        }
 
-    fks = {}
+    columns = get_columns(data)
 
-    for res in data:
-        if not res:
-            continue
-        for k, v in res.items():
-            table_dict[k].append(v)
-            if k in fks_data:
-                fk: ForeignKey = fks_data[k]
-                fks[(nrows, k)] = generate_fk_link(fk.ref_table, fk.ref_column, v)
-        nrows += 1
+    fk_link_prefix = {
+        col: generate_fk_link_prefix(fks_data[col].ref_table, fks_data[col].ref_column)
+        for col in columns
+        if col in fks_data
+    }
+    fks = {
+        (i, col): prefix + urllib.parse.quote(str(row[col]))
+        for col, prefix in fk_link_prefix.items()
+        for i, row in enumerate(data)
+        if row.get(col) is not None
+    }
 
     pp(str(request.query_params))
 
@@ -679,8 +1376,8 @@ async def view_table(
     context = {
         "table_name": table.name,
         "request": request,
-        "table_dict": table_dict,
-        "nrows": nrows,
+        "rows": data,
+        "columns": columns,
         "fks": fks,
         "fks_data": fks_data,
         "next_page": next_page,
@@ -688,13 +1385,17 @@ async def view_table(
         "autoscroll": True,
     }
 
-    if nrows == 0 and hx_request:
+    if not data and hx_request:
         raise NoContent
 
     if hx_request:
-        return templates.TemplateResponse("table-rows.html", context=context)
+        response = stream_template("table-rows.html", context)
+    else:
+        response = stream_template("view-table.html", context)
 
-    return templates.TemplateResponse("view-table.html", context=context)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 @app.get("/run-sql")
@@ -718,30 +1419,20 @@ async def run_sql_view(
         cmd=query,
         remote_sqlite_db=conf.remote_sqlite_path,
         remote_sqlite_bin=conf.remote_sqlite_bin,
+        private_session=True,
     )
 
     if timeout:
         # TODO: Improve error message
         raise QueryTimeoutError("Timeout")
 
-    if not data:
-        data = [{}]
-
-    table_dict = defaultdict(list)
-    nrows = 0
-
-    for res in data:
-        if not res:
-            continue
-        for k, v in res.items():
-            table_dict[k].append(v)
-        nrows += 1
+    columns = get_columns(data)
 
     context = {
         "table_name": "Results",
         "request": request,
-        "table_dict": table_dict,
-        "nrows": nrows,
+        "rows": data,
+        "columns": columns,
         "fks": {},
         "fks_data": None,
         "new_query": "",
@@ -749,13 +1440,14 @@ async def run_sql_view(
         "autoscroll": False,
     }
 
-    response = templates.TemplateResponse("run-sql.html", context)
-    return response
+    return stream_template("run-sql.html", context)
 
 
 @app.get("/disconnect")
 async def rm_conf():
     global SSH_SOCKET_DIR
+    await close_sessions()
+    await SSH_CONTROL.release_all()
     SSH_SOCKET_DIR.cleanup()
     SSH_SOCKET_DIR = tempfile.TemporaryDirectory(prefix="ltx", suffix="tmp-confs")
     response = RedirectResponse("/", status_code=303)
@@ -766,6 +1458,7 @@ async def rm_conf():
 @app.on_event("startup")
 async def app_startup():
     log.info("Setting up application")
+    SSH_CONTROL.start()
     # webbrowser.open_new_tab("http://127.0.0.1:8000")
 
 
@@ -773,4 +1466,6 @@ async def app_startup():
 async def app_shutdown():
     log.info("Shutting down application")
     global SSH_SOCKET_DIR
+    await close_sessions()
+    await SSH_CONTROL.stop()
     SSH_SOCKET_DIR.cleanup()